@@ -20,9 +20,12 @@ the cobalt API extensions.
 
 import os
 import base64
+import calendar
 import re
 import json
 import sys
+import time
+import threading
 
 from novaclient import utils
 from novaclient import base
@@ -31,6 +34,13 @@ from novaclient.v1_1 import servers
 from novaclient.v1_1 import shell
 
 from . import agent
+from . import archive
+from . import bulk
+from . import cache
+from . import connection
+from . import metrics
+from . import overrides
+from . import throttle
 
 # Add new client capabilities here. Each key is a capability name and its value
 # is the list of API capabilities upon which it depends.
@@ -48,6 +58,7 @@ CAPABILITIES = {'user-data': ['user-data'],
                 'get-policy': ['get-policy'],
                 'supports-volumes': ['supports-volumes'],
                 'launch-nics': ['launch-nics'],
+                'list-pagination': ['list-pagination'],
                 }
 
 CAPS_HELP = {'user-data': 'Live-image-start will honor --user-data.',
@@ -63,8 +74,13 @@ CAPS_HELP = {'user-data': 'Live-image-start will honor --user-data.',
              'get-policy': 'Get-policy supported by API.',
              'supports-volumes': 'Instances with volumes attached (boot or hotplug) supported for live-image-*.',
              'launch-nics': 'Live-image-start will honor --nic',
+             'list-pagination': 'Live-image-servers/list are fetched from the API a page at a time.',
             }
 
+# The number of servers fetched at a time when listing live images and
+# their instances.
+DEFAULT_PAGE_SIZE = 100
+
 def __pre_parse_args__():
     pass
 
@@ -82,7 +98,7 @@ def _print_server(cs, server, minimal=False):
     # images. This fixes it as we redo the call with the id which does a
     # .get() to get all informations.
     if not 'flavor' in server._info:
-        server = shell._find_server(cs, server.id)
+        server = cs.cobalt.get(server.id)
 
     networks = server.networks
     info = server._info.copy()
@@ -115,8 +131,42 @@ def _print_server(cs, server, minimal=False):
 
     utils.print_dict(info)
 
+def _server_host(server):
+    """ Returns the host of a server, if visible to us. """
+    return getattr(server, 'OS-EXT-SRV-ATTR:host', None)
+
+def _server_updated(server):
+    """
+    Returns the time a server was last updated according to the API, in
+    seconds since the epoch, or None if it is not known.
+    """
+    updated = getattr(server, 'updated', None)
+    if not updated:
+        return None
+    try:
+        return calendar.timegm(time.strptime(updated[:19],
+                                             '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+def _positive_int(args, name):
+    """ Returns the value of option --name, which must be at least 1. """
+    value = getattr(args, name)
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise exceptions.CommandError("--%s must be a positive integer." %
+                                      name.replace('_', '-'))
+    return value
+
 def _find_server(cs, server):
     """ Returns a server by name or ID. """
+    # Each command should only need to fetch a server once, so the cache is
+    # enabled for the lifetime of the command.
+    if cs.cobalt.cache is None:
+        cs.cobalt.enable_cache()
     return utils.find_resource(cs.cobalt, server)
 
 def parse_nics_arg(arg_nics):
@@ -159,6 +209,34 @@ def inherit_args(inherit_from_fn):
         return fn
     return do_inherit
 
+def metrics_args(fn):
+    """ Decorator adding the arguments handled by _start_metrics(...). """
+    fn = utils.arg('--metrics-interval', metavar='<seconds>', default='10',
+                   help="How often to write out metrics.")(fn)
+    fn = utils.arg('--metrics-format', metavar='<format>', default=None,
+                   choices=['json', 'prometheus'],
+                   help="Write progress metrics as JSON lines or as a "
+                        "Prometheus textfile. JSON lines go to stderr "
+                        "unless --metrics-file is given.")(fn)
+    fn = utils.arg('--metrics-file', metavar='<file>', default=None,
+                   help="Write progress metrics to this file.")(fn)
+    return fn
+
+def _start_metrics(cs, args, operation):
+    """ Starts reporting metrics for a command, if asked to. """
+    if not (args.metrics_file or args.metrics_format):
+        return None
+    m = metrics.Metrics(operation)
+    cs.cobalt.enable_metrics(m)
+    return metrics.Reporter(m, path=args.metrics_file,
+                            format=args.metrics_format or 'json',
+                            interval=int(args.metrics_interval)).start()
+
+def _stop_metrics(cs, reporter):
+    if reporter is not None:
+        reporter.stop()
+        cs.cobalt.enable_metrics(None)
+
 #### ACTIONS ####
 @utils.arg('name', metavar='<name>', help='The name for the new server')
 @utils.arg('--live-image', metavar='<live image>', help="Live-image ID (see 'nova live-image-list')")
@@ -183,10 +261,40 @@ def inherit_args(inherit_from_fn):
          "v4-fixed-ip: IPv4 fixed address for NIC (optional), "
          "port-id: attach NIC to port with this UUID "
          "(required if no net-id)")
+@utils.arg('--shard-size', metavar='<number>', default=None,
+           help='Launch the instances in concurrent batches of at most this many.')
+@utils.arg('--shard-zones', metavar='<availability zones>', default=None,
+           help='Comma separated list of availability zones to spread the batches across.')
+@utils.arg('--parallel', metavar='<number>', default='4',
+           help='Maximum number of batches to launch at a time.')
+@utils.arg('--install-agent', dest='install_agent', action='store_true', default=False,
+           help='Install the agent on each instance as soon as it is ready.')
+@utils.arg('--agent-user', metavar='<user>', default='root',
+           help='The login user for installing the agent.')
+@utils.arg('--agent-key-path', metavar='<key_path>', default=None,
+           help='The path to the private key for installing the agent.')
+@utils.arg('--agent-location', metavar='<agent_location>', default=None,
+           help='Install agent packages from a custom location.')
+@utils.arg('--agent-version', metavar='<agent_version>', default=None,
+           help='Install a specific agent version.')
+@utils.arg('--agent-log-dir', metavar='<log_dir>', default=None,
+           help='Also write the installation output to <log_dir>/<host>.log.')
+@utils.arg('--install-workers', metavar='<number>', default='4',
+           help='Maximum number of agent installations at a time.')
+@utils.arg('--distro-cache', metavar='<file>', default=None,
+           help='File remembering the guest distribution of each live-image '
+                'across runs (e.g. %s). The distribution is always only '
+                'detected once per run.' % agent.DEFAULT_DISTRO_CACHE)
+@metrics_args
 def do_live_image_start(cs, args):
     """Start a new instance from a live-image."""
     if not args.live_image:
         raise exceptions.CommandError("you need to provide a live-image ID")
+    if args.shard_size:
+        _positive_int(args, 'shard_size')
+        _positive_int(args, 'parallel')
+    if args.install_agent:
+        install_workers = _positive_int(args, 'install_workers')
     server = _find_server(cs, args.live_image)
     guest_params = {}
     for param in args.params:
@@ -224,19 +332,121 @@ def do_live_image_start(cs, args):
 
     nics = parse_nics_arg(args.nics)
 
-    launch_servers = cs.cobalt.start_live_image(server,
-        name=args.name,
-        user_data=user_data,
-        guest_params=guest_params,
-        security_groups=security_groups,
-        availability_zone=availability_zone,
-        num_instances=int(args.num_instances),
-        key_name=args.key_name,
-        scheduler_hints=scheduler_hints,
-        networks=nics)
-
-    for server in launch_servers:
+    reporter = _start_metrics(cs, args, 'live-image-start')
+    pipeline = None
+    if args.install_agent:
+        output = agent.OutputCapture(log_dir=args.agent_log_dir)
+        pipeline = agent.install_pipeline(args.agent_user,
+                                          args.agent_key_path,
+                                          location=args.agent_location,
+                                          version=args.agent_version,
+                                          output=output,
+                                          install_workers=install_workers,
+                                          lineage=server.id,
+                                          distro_cache=agent.DistroCache(args.distro_cache),
+                                          metrics=cs.cobalt.metrics)
+
+    def launched(server):
         _print_server(cs, server)
+        if pipeline is not None:
+            pipeline.put(server)
+
+    try:
+        try:
+            if args.shard_size:
+                _start_live_image_sharded(cs, args, server, launched,
+                    name=args.name,
+                    user_data=user_data,
+                    guest_params=guest_params,
+                    security_groups=security_groups,
+                    availability_zone=availability_zone,
+                    key_name=args.key_name,
+                    scheduler_hints=scheduler_hints,
+                    networks=nics)
+            else:
+                launch_servers = cs.cobalt.start_live_image(server,
+                    name=args.name,
+                    user_data=user_data,
+                    guest_params=guest_params,
+                    security_groups=security_groups,
+                    availability_zone=availability_zone,
+                    num_instances=int(args.num_instances),
+                    key_name=args.key_name,
+                    scheduler_hints=scheduler_hints,
+                    networks=nics)
+
+                for server in launch_servers:
+                    launched(server)
+        except Exception:
+            if pipeline is None:
+                raise
+            # Let the installs onto any instances that did start finish, but
+            # report the launch failure rather than theirs.
+            exc_info = sys.exc_info()
+            try:
+                _finish_install_pipeline(pipeline, output)
+            except Exception, e:
+                sys.stderr.write("%s\n" % e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if pipeline is not None:
+            _finish_install_pipeline(pipeline, output)
+    finally:
+        _stop_metrics(cs, reporter)
+
+def _finish_install_pipeline(pipeline, output):
+    """ Waits for all agent installs and reports on them, if there were any. """
+    try:
+        results = pipeline.join()
+    finally:
+        output.close()
+    if len(results) == 0:
+        return
+    latencies = pipeline.latencies()
+    for name, fn, workers in pipeline.stages:
+        times = sorted(latencies[name])
+        if len(times) == 0:
+            continue
+        print "Stage %-8s %d instance(s), min %.1fs, avg %.1fs, max %.1fs" % \
+            (name, len(times), times[0], sum(times) / len(times), times[-1])
+    _print_results(results, [('Stage', lambda r: r.stage or 'done'),
+                             ('Duration', lambda r: '%.1f' % r.duration)])
+
+def _start_live_image_sharded(cs, args, server, launched, **kwargs):
+    """ Launches in shards, calling launched(server) as each completes. """
+    if args.shard_zones:
+        zones = args.shard_zones.split(',')
+    else:
+        zones = None
+    lock = threading.Lock()
+
+    def shard_done(result):
+        lock.acquire()
+        try:
+            shard = result.item
+            if result.ok:
+                for launched_server in result.value:
+                    launched(launched_server)
+            else:
+                sys.stderr.write("Failed to launch %d instance(s) in shard %d"
+                                 " (availability zone %s): %s\n" %
+                                 (shard['num_instances'], shard['index'],
+                                  shard['availability_zone'], result.error))
+        finally:
+            lock.release()
+
+    results = cs.cobalt.start_live_image_sharded(server,
+        num_instances=int(args.num_instances),
+        shard_size=_positive_int(args, 'shard_size'),
+        availability_zones=zones,
+        max_parallel=_positive_int(args, 'parallel'),
+        callback=shard_done,
+        **kwargs)
+
+    failed = [r.item['num_instances'] for r in results if not r.ok]
+    if len(failed) > 0:
+        raise exceptions.CommandError("%d of %d shard(s) failed to launch"
+                                      " %d instance(s)." %
+                                      (len(failed), len(results), sum(failed)))
 
 @utils.arg('live_image', metavar='<live image>', help="Live-image ID (see 'nova live-image-list')")
 @utils.arg('--name', metavar='<name>', default=None, help='The name for the new server')
@@ -252,6 +462,10 @@ def do_live_image_start(cs, args):
 def do_launch(cs, args):
     """DEPRECATED! Use live-image-start instead."""
     args.nics = []
+    args.shard_size = None
+    args.install_agent = False
+    args.metrics_file = None
+    args.metrics_format = None
     do_live_image_start(cs, args)
 
 @utils.arg('server', metavar='<instance>', help="Name or ID of server.")
@@ -269,23 +483,135 @@ def do_bless(cs, args):
     """DEPRECATED! Use live-image-create instead."""
     do_live_image_create(cs, args)
 
-@utils.arg('live_image', metavar='<live-image>', help="ID or name of the live-image")
+def _print_results(results, extra_columns=[], first_columns=None):
+    """
+    Prints a per-server summary of a bulk operation. Extra columns are given
+    as a list of (name, formatter) pairs. The leading columns are the ID and
+    name of each item, unless first_columns gives others in the same form.
+    """
+    if first_columns is None:
+        first_columns = [('ID', lambda r: r.item.id),
+                         ('Name', lambda r: r.item.name)]
+    columns = [name for name, _ in first_columns + extra_columns] + ['Result']
+    formatters = dict(first_columns + extra_columns)
+    formatters['Result'] = lambda r: r.ok and 'OK' or str(r.error)
+    utils.print_list(results, columns, formatters)
+    failed = len([r for r in results if not r.ok])
+    if failed > 0:
+        raise exceptions.CommandError("%d of %d operations failed." %
+                                      (failed, len(results)))
+
+def _collect_live_images(cs, args):
+    """
+    Returns the live-images named by args.live_image, args.match and
+    args.lineage without duplicates, along with a dict of the lineage depth
+    of each of the live-images found through args.lineage.
+    """
+    live_images = [_find_server(cs, live_image) for live_image in args.live_image]
+    depths = {}
+    if args.match:
+        live_images.extend(cs.cobalt.find_live_images(args.match))
+    if args.lineage:
+        root = _find_server(cs, args.lineage)
+        for live_image, depth in cs.cobalt.live_image_lineage(root):
+            live_images.append(live_image)
+            depths[live_image.id] = depth
+
+    unique = {}
+    for live_image in live_images:
+        unique[live_image.id] = live_image
+    return unique.values(), depths
+
+@utils.arg('live_image', metavar='<live-image>', nargs='*', help="ID or name of the live-image")
+@utils.arg('--match', metavar='<regex>', default=None,
+           help="Delete all live-images whose name matches this pattern.")
+@utils.arg('--lineage', metavar='<instance>', default=None,
+           help="Delete all live-images descended from this instance or live-image.")
+@utils.arg('--parallel', metavar='<number>', default='4',
+           help="Maximum number of live-images to delete at a time.")
+@metrics_args
 def do_live_image_delete(cs, args):
-    """Delete a live image."""
-    server = _find_server(cs, args.live_image)
-    cs.cobalt.delete_live_image(server)
+    """Delete one or more live images."""
+    if len(args.live_image) == 1 and not (args.match or args.lineage):
+        server = _find_server(cs, args.live_image[0])
+        cs.cobalt.delete_live_image(server)
+        return
+
+    max_workers = _positive_int(args, 'parallel')
+    live_images, depths = _collect_live_images(cs, args)
+    if len(live_images) == 0:
+        raise exceptions.CommandError("No live-images to delete.")
+
+    reporter = _start_metrics(cs, args, 'live-image-delete')
+    try:
+        results = cs.cobalt.delete_live_images(live_images,
+                                               depths=depths,
+                                               max_workers=max_workers)
+    finally:
+        _stop_metrics(cs, reporter)
+    _print_results(results)
 
 @inherit_args(do_live_image_delete)
 def do_discard(cs, args):
     """DEPRECATED! Use live-image-delete instead."""
     do_live_image_delete(cs, args)
 
-@utils.arg('server', metavar='<instance>', help="ID or name of the instance to migrate")
-@utils.arg('--dest', metavar='<destination host>', default=None, help="Host to migrate to")
+@utils.arg('server', metavar='<instance>', nargs='*', help="ID or name of the instance to migrate")
+@utils.arg('--dest', metavar='<destination host>', action='append', default=[],
+           help="Host to migrate to. May be given multiple times to spread a bulk migration.")
+@utils.arg('--host', metavar='<source host>', default=None,
+           help="Migrate all instances off of this host.")
+@utils.arg('--parallel', metavar='<number>', default='4',
+           help="Maximum number of migrations in flight at a time.")
+@utils.arg('--per-dest', metavar='<number>', default='2',
+           help="Maximum number of migrations in flight to any one --dest.")
+@utils.arg('--timeout', metavar='<seconds>', default='1800',
+           help="How long to wait for each migration to complete.")
+@metrics_args
 def do_cobalt_migrate(cs, args):
-    """Migrate an instance using VMS."""
-    server = _find_server(cs, args.server)
-    cs.cobalt.migrate(server, args.dest)
+    """Migrate one or more instances using VMS."""
+    if len(args.server) == 1 and len(args.dest) <= 1 and not args.host:
+        server = _find_server(cs, args.server[0])
+        cs.cobalt.migrate(server, args.dest and args.dest[0] or None)
+        return
+
+    kwargs = {'dests': args.dest,
+              'max_parallel': _positive_int(args, 'parallel'),
+              'max_per_dest': _positive_int(args, 'per_dest'),
+              'timeout': int(args.timeout)}
+
+    def progress(result):
+        if result.ok:
+            sys.stderr.write("Migrated %s to %s in %.1fs.\n" %
+                             (result.item.id, result.value, result.duration))
+        else:
+            sys.stderr.write("Failed to migrate %s: %s\n" %
+                             (result.item.id, result.error))
+    kwargs['callback'] = progress
+
+    if not args.host:
+        servers = [_find_server(cs, server) for server in args.server]
+        if len(servers) == 0:
+            raise exceptions.CommandError("No instances to migrate.")
+
+    reporter = _start_metrics(cs, args, 'cobalt-migrate')
+    start = time.time()
+    try:
+        if args.host:
+            results = cs.cobalt.evacuate_host(args.host, **kwargs)
+        else:
+            results = cs.cobalt.migrate_servers(servers, **kwargs)
+    finally:
+        _stop_metrics(cs, reporter)
+    elapsed = time.time() - start
+    if len(results) == 0:
+        raise exceptions.CommandError("No instances to migrate.")
+
+    migrated = len([r for r in results if r.ok])
+    print "Migrated %d instance(s) in %.1fs (%.2f per minute)." % \
+        (migrated, elapsed, migrated * 60.0 / max(elapsed, 1))
+    _print_results(results, [('Host', lambda r: r.value or ''),
+                             ('Duration', lambda r: '%.1f' % r.duration)])
 
 @inherit_args(do_cobalt_migrate)
 def do_gc_migrate(cs, args):
@@ -298,11 +624,53 @@ def _print_list(servers):
     formatters = {'Networks':utils._format_servers_list_networks}
     utils.print_list(servers, columns, formatters)
 
+def _print_pages(servers, page_size):
+    """ Prints servers as a table per page, as each page arrives. """
+    page = []
+    for server in servers:
+        page.append(server)
+        if len(page) == page_size:
+            _print_list(page)
+            page = []
+    if len(page) > 0:
+        _print_list(page)
+
 @utils.arg('live_image', metavar='<live-image>', help="ID or name of the live-image")
+@utils.arg('--page-size', metavar='<number>', default=str(DEFAULT_PAGE_SIZE),
+           help="Number of instances to fetch and print at a time.")
+@utils.arg('--watch', dest='watch', action='store_true', default=False,
+           help="Keep watching the instances and print their status changes.")
+@utils.arg('--interval', metavar='<seconds>', default='10',
+           help="How often to poll for changes when watching.")
 def do_live_image_servers(cs, args):
     """List instances started from this live-image."""
     server = _find_server(cs, args.live_image)
-    _print_list(cs.cobalt.list_live_image_servers(server))
+    page_size = _positive_int(args, 'page_size')
+    servers = cs.cobalt.iter_live_image_servers(server, page_size)
+    if not args.watch:
+        _print_pages(servers, page_size)
+        return
+
+    # Only a watch needs to remember the instances it has already printed.
+    known = []
+    def record(servers):
+        for clone in servers:
+            known.append(clone)
+            yield clone
+    _print_pages(record(servers), page_size)
+
+    for change, clone, old_status in \
+        cs.cobalt.watch_live_image_servers(server, interval=int(args.interval),
+                                           known=known):
+        stamp = time.strftime('%H:%M:%S')
+        if change == 'added':
+            print "%s + %s %s %s" % (stamp, clone.id, clone.name, clone.status)
+        elif change == 'removed':
+            print "%s - %s %s" % (stamp, clone.id, clone.name)
+        else:
+            print "%s ~ %s %s %s -> %s" % (stamp, clone.id, clone.name,
+                                           old_status, clone.status)
+        sys.stdout.flush()
 
 @inherit_args(do_live_image_servers)
 def do_list_launched(cs, args):
@@ -310,59 +678,199 @@ def do_list_launched(cs, args):
     do_live_image_servers(cs, args)
 
 @utils.arg('server', metavar='<server>', help="ID or name of the instance")
+@utils.arg('--page-size', metavar='<number>', default=str(DEFAULT_PAGE_SIZE),
+           help="Number of live-images to fetch and print at a time.")
 def do_live_image_list(cs, args):
     """List the live images of this instance."""
     server = _find_server(cs, args.server)
-    _print_list(cs.cobalt.list_live_images(server))
+    page_size = _positive_int(args, 'page_size')
+    _print_pages(cs.cobalt.iter_live_images(server, page_size), page_size)
 
 @inherit_args(do_live_image_list)
 def do_list_blessed(cs, args):
     """DEPRECATED! Use live-image-list instead."""
     do_live_image_list(cs, args)
 
+def _format_bytes(size):
+    if size is None:
+        return ''
+    if size < 1024:
+        return '%dB' % size
+    for unit in ['KB', 'MB', 'GB', 'TB']:
+        size /= 1024.0
+        if size < 1024:
+            break
+    return '%.1f%s' % (size, unit)
+
+def export_wait_args(fn):
+    """ Adds the arguments used by _wait_for_exports(...). """
+    fn = utils.arg('--wait', action='store_true', default=False,
+                   help="Wait for the export images to become active.")(fn)
+    fn = utils.arg('--wait-timeout', metavar='<seconds>', default='3600',
+                   help="How long to wait for the export images.")(fn)
+    return fn
+
+def _wait_for_exports(cs, args, results):
+    """
+    Waits for the export images of the successful exports in results, and
+    marks the exports whose image did not become active as failed. Each
+    export is given the size and wait time of its image.
+    """
+    exported = [r for r in results if r.ok]
+    for result in results:
+        result.size = None
+        result.wait = None
+    if len(exported) == 0:
+        return
+
+    def progress(image):
+        if image.ok:
+            print "Export image %s is active after %.1fs (%s, %s/s)." % \
+                (image.item, image.duration, _format_bytes(image.size),
+                 _format_bytes((image.size or 0) / max(image.duration, 1)))
+        else:
+            print "Export image %s failed after %.1fs: %s" % \
+                (image.item, image.duration, image.error)
+
+    print "Waiting for %d export image(s)." % len(exported)
+    start = time.time()
+    images = cs.cobalt.wait_for_images([r.value['export_image_id']
+                                        for r in exported],
+                                       timeout=int(args.wait_timeout),
+                                       callback=progress)
+    elapsed = time.time() - start
+
+    for result, image in zip(exported, images):
+        result.size = image.size
+        result.wait = image.duration
+        if not image.ok:
+            result.error = image.error
+    total = sum([image.size or 0 for image in images if image.ok])
+    print "%d of %d export image(s) active, %s in %.1fs (%s/s)." % \
+        (len([image for image in images if image.ok]), len(images),
+         _format_bytes(total), elapsed, _format_bytes(total / max(elapsed, 1)))
+
 @utils.arg('server', metavar='<live-image>', help="ID or name of the live-image")
 @utils.arg('output', metavar='<output>', default=None, help="Name of a file to write the exported data to.")
+@export_wait_args
 def do_live_image_export(cs, args):
     """Export a live-image"""
     server = _find_server(cs, args.server)
     result = server.export()
 
-    json_result = json.dumps(result, sort_keys=True, indent=4, separators=(',', ': ')) + '\n'
-
     with file(args.output, 'w') as f:
-        f.write(json_result)
+        f.write(archive.format_export(result))
 
     print "Instance data is being exported to image %s" %(result['export_image_id'])
 
-@utils.arg('data_filename', metavar='<data-filename>',
+    if args.wait:
+        results = [bulk.Result(server)]
+        results[0].value = result
+        _wait_for_exports(cs, args, results)
+        if not results[0].ok:
+            raise exceptions.CommandError(str(results[0].error))
+
+@utils.arg('output', metavar='<output>', help="Name of the archive file to write the exported data to.")
+@utils.arg('live_image', metavar='<live-image>', nargs='*', help="ID or name of the live-image")
+@utils.arg('--match', metavar='<regex>', default=None,
+           help="Export all live-images whose name matches this pattern.")
+@utils.arg('--lineage', metavar='<instance>', default=None,
+           help="Export all live-images descended from this instance or live-image.")
+@utils.arg('--parallel', metavar='<number>', default='4',
+           help="Maximum number of live-images to export at a time.")
+@export_wait_args
+@metrics_args
+def do_live_image_export_archive(cs, args):
+    """Export many live-images into a single archive."""
+    max_workers = _positive_int(args, 'parallel')
+    live_images, depths = _collect_live_images(cs, args)
+    if len(live_images) == 0:
+        raise exceptions.CommandError("No live-images to export.")
+
+    output = archive.ExportArchive(args.output)
+    def exported(result):
+        if result.ok:
+            output.add(result.item, result.value)
+
+    reporter = _start_metrics(cs, args, 'live-image-export-archive')
+    try:
+        try:
+            results = cs.cobalt.export_live_images(live_images,
+                                                   max_workers=max_workers,
+                                                   callback=exported)
+        finally:
+            output.close()
+        if args.wait:
+            _wait_for_exports(cs, args, results)
+    finally:
+        _stop_metrics(cs, reporter)
+
+    extra_columns = [('Export Image',
+                      lambda r: r.value and r.value['export_image_id'] or '')]
+    if args.wait:
+        extra_columns += [('Size', lambda r: _format_bytes(r.size)),
+                          ('Wait', lambda r: r.wait is not None and
+                                             '%.1f' % r.wait or '')]
+    _print_results(results, extra_columns)
+
+def _read_exports(args):
+    """
+    Yields a (source, data) pair for every export named by args.data_filename,
+    which are either JSON files written by live-image-export or archives
+    written by live-image-export-archive.
+    """
+    for filename in args.data_filename:
+        if args.entry is not None:
+            yield filename, archive.read_entry(filename, args.entry)
+        elif archive.is_archive(filename):
+            for entry, data in archive.iter_entries(filename):
+                yield '%s:%s' % (filename, entry['file']), data
+        else:
+            # Read in the contents of the server data (should be a JSON file)
+            with open(filename, 'r') as f:
+                yield filename, json.load(f)
+
+@utils.arg('data_filename', metavar='<data-filename>', nargs='+',
                               help="A file containing the exported server data")
 @utils.arg('--override', metavar='<override>',
                       help="Semicolon-separated list of parameters to override")
+@utils.arg('--entry', metavar='<live-image>', default=None,
+           help="Import this live-image from an archive written by live-image-export-archive.")
+@utils.arg('--parallel', metavar='<number>', default='4',
+           help="Maximum number of live-images to import at a time.")
 def do_live_image_import(cs, args):
     """Import a live-image"""
 
     # The override option can be something like this:
     # export_image_id=THE-ID;security_groups=sg1,sg2;fields.display_name=foo
+    # Paths may also index lists, or use * for every element:
+    # networks.*.net_id=NET-ID;security_groups.0=default
+
+    # Every export is read and overridden before anything is imported, so
+    # that a bad file or override does not leave a partial import behind.
+    max_workers = _positive_int(args, 'parallel')
+    try:
+        plan = overrides.compile_plan(args.override)
+        imports = []
+        for source, data in _read_exports(args):
+            try:
+                imports.append((source, plan.apply(data)))
+            except overrides.OverrideError, e:
+                raise overrides.OverrideError("%s: %s" % (source, e))
+    except Exception, e:
+        raise exceptions.CommandError(str(e))
+
+    if len(imports) == 1:
+        server = cs.cobalt.import_instance(imports[0][1])
+        _print_server(cs, server)
+        return
 
-    # Read in the contents of the server data (should be a JSON file)
-    with open(args.data_filename, 'r') as f:
-        data = json.load(f)
-
-    if args.override is not None:
-        def override(key, value, data):
-            if '.' in key:
-                parent, _, key = key.partition('.')
-                override(key, value, data[parent])
-            else:
-                if isinstance(data[key], list):
-                    value = value.split(',')
-                data[key] = value
-        for override_arg in args.override.split(';'):
-            key, value = override_arg.split('=', 1)
-            override(key, value, data)
-
-    server = cs.cobalt.import_instance(data)
-    _print_server(cs, server)
+    results = bulk.run_parallel(lambda item: cs.cobalt.import_instance(item[1]),
+                                imports, max_workers=max_workers)
+    _print_results(results, first_columns=[
+        ('Source', lambda r: r.item[0]),
+        ('ID', lambda r: r.ok and r.value.id or ''),
+        ('Name', lambda r: r.ok and r.value.name or '')])
 
 @utils.arg('policy_filename', metavar='<policy-filename>',
            help='Path to file containing vmspolicyd policy definitions')
@@ -418,14 +926,46 @@ def do_cobalt_capabilities(cs, args):
      default=None,
      metavar='<ip>',
      help="Instance IP address to use (defaults to first ssh-able).")
+@utils.arg('--log-dir',
+     default=None,
+     metavar='<log_dir>',
+     help="Capture the installation output, prefixed with the host, and "
+          "also write it to <log_dir>/<host>.log.")
+@utils.arg('--live-image',
+     default=None,
+     metavar='<live_image>',
+     help="The live-image the instance was started from. The guest "
+          "distribution is then only detected once per live-image.")
+@utils.arg('--distro-cache',
+     default=None,
+     metavar='<file>',
+     help="File remembering the guest distribution of each live-image "
+          "across runs (e.g. %s). Used with --live-image." %
+          agent.DEFAULT_DISTRO_CACHE)
 def do_cobalt_install_agent(cs, args):
     """Install the agent onto an instance."""
     server = _find_server(cs, args.server)
-    server.install_agent(args.user,
-                         args.key_path,
-                         location=args.agent_location,
-                         version=args.agent_version,
-                         ip=args.ip)
+    if args.log_dir:
+        output = agent.OutputCapture(log_dir=args.log_dir)
+    else:
+        output = None
+    lineage = None
+    distro_cache = None
+    if args.live_image:
+        lineage = _find_server(cs, args.live_image).id
+        distro_cache = agent.DistroCache(args.distro_cache)
+    try:
+        server.install_agent(args.user,
+                             args.key_path,
+                             location=args.agent_location,
+                             version=args.agent_version,
+                             ip=args.ip,
+                             output=output,
+                             lineage=lineage,
+                             distro_cache=distro_cache)
+    finally:
+        if output is not None:
+            output.close()
 
 @inherit_args(do_cobalt_install_agent)
 def do_gc_install_agent(cs, args):
@@ -437,6 +977,12 @@ class CoServer(servers.Server):
     A server object extended to provide cobalt capabilities
     """
 
+    def get(self):
+        # An explicit refresh must always go to the API.
+        if self.manager.cache is not None:
+            self.manager.cache.invalidate(self.id)
+        servers.Server.get(self)
+
     def launch(self, *args, **kwargs):
         """ Deprecated. Please use the start_live_image(...). """
         return self.start_live_image(*args, **kwargs)
@@ -491,9 +1037,11 @@ class CoServer(servers.Server):
         return self.manager.export(self)
 
     def install_agent(self, user, key_path, location=None,
-                        version=None, ip=None):
+                        version=None, ip=None, output=None, lineage=None,
+                        distro_cache=None):
         self.manager.install_agent(self, user, key_path, location=location,
-                                    version=version, ip=ip)
+                                    version=version, ip=ip, output=output,
+                                    lineage=lineage, distro_cache=distro_cache)
 
     def get_policy(self):
         return self.manager.get_policy(self)
@@ -502,8 +1050,22 @@ class CoServerManager(servers.ServerManager):
     resource_class = CoServer
 
     def __init__(self, client, *args, **kwargs):
+        session = kwargs.pop('session', None)
+        pool_options = {}
+        for option in ['pool_size', 'pool_per_host', 'idle_timeout']:
+            if option in kwargs:
+                pool_options[option] = kwargs.pop(option)
         servers.ServerManager.__init__(self, client, *args, **kwargs)
 
+        self.session = None
+        self.session_attached = False
+        if session is not None or pool_options:
+            self.configure_session(session, **pool_options)
+
+        self.metrics = None
+        self.configure_scheduler()
+        self.cache = None
+
         # Make sure this instance is available as cobalt.
         if not(hasattr(client, 'cobalt')):
             setattr(client, 'cobalt', self)
@@ -527,9 +1089,127 @@ class CoServerManager(servers.ServerManager):
 
         return set(requirements) <= set(self.capabilities)
 
+    def configure_session(self, session=None,
+                          pool_size=connection.DEFAULT_POOL_SIZE,
+                          pool_per_host=connection.DEFAULT_POOL_PER_HOST,
+                          idle_timeout=connection.DEFAULT_IDLE_TIMEOUT):
+        """
+        Sends all API requests through a keep-alive session, so that
+        connections are reused between calls. If no session is given, a
+        connection.PooledSession is built from the pool options.
+        """
+        if session is None:
+            if connection.requests is None:
+                raise Exception("Connection pooling requires requests.")
+            session = connection.PooledSession(pool_size=pool_size,
+                                               pool_per_host=pool_per_host,
+                                               idle_timeout=idle_timeout)
+        self.session = session
+        self.session_attached = False
+
+    def configure_scheduler(self, rate=None, burst=1, retries=5, backoff=1.0):
+        """
+        Sets up the scheduler shared by all API calls made by this manager.
+        At most rate calls per second are made (with bursts of up to burst
+        calls), and calls that are safe to repeat are retried up to retries
+        times when the API is too busy to handle them. See
+        throttle.ActionScheduler.
+        """
+        self.scheduler = throttle.ActionScheduler(rate=rate, burst=burst,
+                                                  retries=retries,
+                                                  backoff=backoff)
+        self.scheduler.metrics = self.metrics
+
+    def enable_metrics(self, metrics):
+        """
+        Records the progress of bulk operations and all API calls in the
+        given metrics.Metrics (or stops recording if it is None).
+        """
+        self.metrics = metrics
+        self.scheduler.metrics = metrics
+
+    def enable_cache(self, ttl=cache.DEFAULT_TTL, max_size=cache.DEFAULT_SIZE):
+        """
+        Caches server details for ttl seconds, so that get(...) does not
+        fetch the same server again. The cache is filled from get(...) and
+        detailed list(...) replies, and entries are dropped whenever an
+        action that may change the server is taken on it.
+        """
+        self.cache = cache.ServerCache(ttl=ttl, max_size=max_size)
+
+    def disable_cache(self):
+        self.cache = None
+
+    def get(self, server, refresh=False):
+        if self.cache is not None and not refresh:
+            info = self.cache.get(base.getid(server))
+            if info is not None:
+                return self.resource_class(self, dict(info), loaded=True)
+        result = servers.ServerManager.get(self, server)
+        if self.cache is not None:
+            self.cache.put(result._info)
+        return result
+
+    def list(self, *args, **kwargs):
+        result = servers.ServerManager.list(self, *args, **kwargs)
+        if self.cache is not None:
+            for server in result:
+                # Only full server details are worth caching.
+                if 'flavor' in server._info:
+                    self.cache.put(server._info)
+        return result
+
+    def session_stats(self):
+        """ Returns the connection reuse statistics of the session. """
+        if self.session is None or not hasattr(self.session, 'stats'):
+            return {}
+        return self.session.stats()
+
+    # Like capabilities, the session is attached lazily because
+    # self.api.client isn't available in __init__
+
+    def _client(self):
+        if self.session is not None and not self.session_attached:
+            if not connection.attach(self.api.client, self.session):
+                raise Exception("This novaclient does not support sessions.")
+            self.session_attached = True
+        return self.api.client
+
+    def _action(self, action, server, info=None, **kwargs):
+        # Actions are only retried when they are read-only, or when the
+        # caller says that repeating them is harmless.
+        retry = kwargs.pop('idempotent', False) or \
+                action in throttle.SAFE_ACTIONS
+        done_if = kwargs.pop('done_if', None)
+        if self.cache is not None and action not in throttle.SAFE_ACTIONS:
+            self.cache.invalidate(base.getid(server))
+        self._client()
+        return self.scheduler.run(
+            lambda: servers.ServerManager._action(self, action, server, info,
+                                                  **kwargs),
+            retry=retry, done_if=done_if)
+
+    def _get(self, *args, **kwargs):
+        self._client()
+        return self.scheduler.run(
+            lambda: servers.ServerManager._get(self, *args, **kwargs),
+            retry=True)
+
+    def _list(self, *args, **kwargs):
+        self._client()
+        return self.scheduler.run(
+            lambda: servers.ServerManager._list(self, *args, **kwargs),
+            retry=True)
+
+    def _create(self, *args, **kwargs):
+        self._client()
+        return self.scheduler.run(
+            lambda: servers.ServerManager._create(self, *args, **kwargs))
+
     def get_info(self):
         url = '/gcinfo'
-        res = self.api.client.get(url)[1]
+        res = self.scheduler.run(lambda: self._client().get(url)[1],
+                                 retry=True)
         return res
 
     def launch(self, *args, **kwargs):
@@ -583,6 +1263,51 @@ class CoServerManager(servers.ServerManager):
         header, info = self._action("gc_launch", base.getid(server), params)
         return [self.get(server['id']) for server in info]
 
+    def start_live_image_sharded(self, server, num_instances=1, shard_size=10,
+                                 availability_zones=None,
+                                 max_parallel=bulk.DEFAULT_WORKERS,
+                                 callback=None, **kwargs):
+        """
+        Starts num_instances from a live image as several launches of at most
+        shard_size instances each, with at most max_parallel launches in
+        flight. If availability_zones is given the shards are spread across
+        them in turn. Other arguments are as for start_live_image(...).
+
+        Returns a list of bulk.Result objects, one per shard. The item of each
+        is a dict with the 'index', 'num_instances' and 'availability_zone'
+        of the shard, and the value the list of servers it started. If given,
+        callback(result) is invoked as each shard finishes.
+        """
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1.")
+        user_data = kwargs.get('user_data')
+        if hasattr(user_data, 'read'):
+            # Every shard needs the contents, so only read them once.
+            kwargs['user_data'] = user_data.read()
+        if not availability_zones:
+            availability_zones = [kwargs.pop('availability_zone', None)]
+        else:
+            kwargs.pop('availability_zone', None)
+
+        shards = []
+        remaining = num_instances
+        while remaining > 0:
+            count = min(shard_size, remaining)
+            zone = availability_zones[len(shards) % len(availability_zones)]
+            shards.append({'index': len(shards),
+                           'num_instances': count,
+                           'availability_zone': zone})
+            remaining -= count
+
+        def launch(shard):
+            return self.start_live_image(server,
+                        num_instances=shard['num_instances'],
+                        availability_zone=shard['availability_zone'],
+                        **kwargs)
+        return bulk.run_parallel(launch, shards, max_workers=max_parallel,
+                                 callback=callback, metrics=self.metrics,
+                                 phase='launch')
+
     def bless(self, *args, **kwargs):
         """ Deprecated. Please use create_live_image(...). """
         return self.create_live_image(*args, **kwargs)
@@ -597,34 +1322,436 @@ class CoServerManager(servers.ServerManager):
         return self.delete_live_image(*args, **kwargs)
 
     def delete_live_image(self, server):
-        return self._action("gc_discard", base.getid(server))
-
-    def migrate(self, server, dest=None):
+        return self._action("gc_discard", base.getid(server), idempotent=True)
+
+    def find_live_images(self, pattern):
+        """ Returns all live images whose name matches the regex pattern. """
+        regex = re.compile(pattern)
+        return [server for server in self.list(search_opts={'name': pattern})
+                if server.status == 'BLESSED' and regex.search(server.name)]
+
+    def live_image_lineage(self, root):
+        """
+        Returns a list of (live_image, depth) for every live image descended
+        from root. Root may be either an instance or a live image. Live images
+        of root have depth 0, live images of their clones depth 1 and so on.
+        """
+        if getattr(root, 'status', None) == 'BLESSED':
+            pending = [(root, 0)]
+        else:
+            pending = [(live_image, 0) for live_image in
+                       self.list_live_images(root)]
+        seen = set()
+        lineage = []
+        while pending:
+            live_image, depth = pending.pop(0)
+            if live_image.id in seen:
+                continue
+            seen.add(live_image.id)
+            lineage.append((live_image, depth))
+            for clone_id in self._live_image_server_ids(live_image):
+                pending.extend([(child, depth + 1) for child in
+                                self.list_live_images(clone_id)])
+        return lineage
+
+    def delete_live_images(self, live_images, depths=None,
+                           max_workers=bulk.DEFAULT_WORKERS, callback=None):
+        """
+        Deletes many live images concurrently, using at most max_workers
+        threads. Rate limited discards are retried by the scheduler. Live
+        images that still have running clones are not deleted. If depths maps
+        live image IDs to their lineage depth then the deepest live images are
+        deleted first. Returns a list of bulk.Result objects.
+        """
+        if depths is None:
+            depths = {}
+
+        def discard(live_image):
+            clones = self._live_image_server_ids(live_image)
+            if len(clones) > 0:
+                raise Exception("Live image still has %d running clone(s)." %
+                                len(clones))
+            self.delete_live_image(live_image)
+
+        waves = {}
+        for live_image in live_images:
+            depth = depths.get(base.getid(live_image), 0)
+            waves.setdefault(depth, []).append(live_image)
+
+        results = []
+        for depth in sorted(waves.keys(), reverse=True):
+            results.extend(bulk.run_parallel(discard, waves[depth],
+                                             max_workers=max_workers,
+                                             callback=callback,
+                                             metrics=self.metrics,
+                                             phase='delete'))
+        return results
+
+    def migrate(self, server, dest=None, idempotent=False):
         params = {}
         if dest != None:
             params['dest'] = dest
-        return self._action("gc_migrate", base.getid(server), params)
+        # NOTE: A repeated migrate of an instance which is already migrating
+        # is rejected with a 409. On a retry, that means an earlier attempt
+        # was accepted (despite its error response), so it is not an error.
+        return self._action("gc_migrate", base.getid(server), params,
+                            idempotent=idempotent,
+                            done_if=lambda e: getattr(e, 'code', None) == 409)
+
+    def list_host_servers(self, host):
+        """ Returns all of the instances running on the given host. """
+        return self.list(search_opts={'host': host, 'all_tenants': 1})
+
+    def evacuate_host(self, host, dests=None, **kwargs):
+        """ Migrates every instance off of host. See migrate_servers(...). """
+        dests = [dest for dest in (dests or []) if dest != host]
+        return self.migrate_servers(self.list_host_servers(host),
+                                    dests=dests, **kwargs)
+
+    def migrate_servers(self, servers, dests=None, max_parallel=4,
+                        max_per_dest=2, timeout=1800, interval=5,
+                        callback=None):
+        """
+        Migrates many instances and waits for each migration to complete.
+
+        At most max_parallel migrations are in flight at once, and at most
+        max_per_dest to any one destination. When dests is given, each
+        instance is sent to the least busy destination, otherwise the
+        scheduler picks a destination for it and only max_parallel applies.
+        Completion is detected by the instance changing host, so instances
+        whose host is not visible to us (see _server_host) fail without
+        being migrated. All in-flight migrations are
+        tracked by a single poller every interval seconds. Returns a list of
+        bulk.Result objects in the order of servers, where value is the host
+        the instance ended up on and duration is the time its migration took.
+        If given, callback(result) is invoked as each migration finishes.
+        """
+        results = [bulk.Result(server) for server in servers]
+        pending = list(results)
+        inflight = {}
+        busy = {}
+        if not dests:
+            dests = [None]
+        metrics = self.metrics
+        if metrics is not None:
+            for result in results:
+                metrics.set_state(result.item.id, 'pending')
+
+        for result in list(pending):
+            if _server_host(result.item) is None:
+                pending.remove(result)
+                result.error = Exception("The host of instance %s is not "
+                                         "visible, so its migration cannot "
+                                         "be tracked." % result.item.id)
+                if metrics is not None:
+                    metrics.set_state(result.item.id, 'failed')
+                if callback is not None:
+                    callback(result)
+
+        def finish(result, host=None, error=None):
+            inflight.pop(result.item.id, None)
+            busy[result.dest] -= 1
+            result.value = host
+            result.error = error
+            result.duration = time.time() - result.start
+            if metrics is not None:
+                metrics.end()
+                metrics.observe('migrate', result.duration)
+                metrics.set_state(result.item.id,
+                                  result.ok and 'done' or 'failed')
+            if callback is not None:
+                callback(result)
+
+        while pending or inflight:
+            # Start as many new migrations as our limits allow.
+            for result in list(pending):
+                if len(inflight) >= max_parallel:
+                    break
+                source = _server_host(result.item)
+                candidates = [dest for dest in dests if dest != source and
+                              (dest is None or
+                               busy.get(dest, 0) < max_per_dest)]
+                if len(candidates) == 0:
+                    continue
+                dest = min(candidates, key=lambda d: busy.get(d, 0))
+                pending.remove(result)
+                result.dest = dest
+                result.source = source
+                result.seen_migrating = False
+                result.start = time.time()
+                busy[dest] = busy.get(dest, 0) + 1
+                inflight[result.item.id] = result
+                if metrics is not None:
+                    metrics.begin()
+                    metrics.set_state(result.item.id, 'migrating')
+                try:
+                    # NOTE: Retrying is safe, see migrate(...).
+                    self.migrate(result.item, dest, idempotent=True)
+                except Exception, e:
+                    finish(result, error=e)
+
+            if not inflight:
+                # Nothing left could be placed (e.g. the only destination is
+                # the source host of every remaining instance).
+                for result in pending:
+                    result.error = Exception("No destination available.")
+                    if metrics is not None:
+                        metrics.set_state(result.item.id, 'failed')
+                break
+            time.sleep(interval)
+
+            # Poll all of the in-flight migrations.
+            for result in inflight.values():
+                try:
+                    server = self.get(result.item.id, refresh=True)
+                except Exception, e:
+                    finish(result, error=e)
+                    continue
+                host = _server_host(server)
+                if server.status == 'ERROR':
+                    finish(result, host,
+                           Exception("Instance went into ERROR state."))
+                elif server.status == 'ACTIVE' and host != result.source:
+                    finish(result, host)
+                elif server.status == 'ACTIVE' and result.seen_migrating:
+                    finish(result, host,
+                           Exception("Instance is still on %s after migrating."
+                                     % host))
+                elif time.time() - result.start > timeout:
+                    finish(result, host,
+                           Exception('Timeout: waited %ss for migration.' %
+                                     timeout))
+                elif server.status == 'MIGRATING':
+                    result.seen_migrating = True
+        return results
 
     def list_launched(self, *args, **kwargs):
         """ Deprecated. Please use list_live_image_servers(...)."""
         return self.list_live_image_servers(*args, **kwargs)
 
     def list_live_image_servers(self, server):
+        return list(self.iter_live_image_servers(server))
+
+    def iter_live_image_servers(self, server, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Yields the instances started from a live image, fetching them a page
+        of page_size at a time. See _iter_pages(...).
+        """
+        return self._iter_pages("gc_list_launched", server, page_size)
+
+    def watch_live_image_servers(self, server, interval=10, known=None,
+                                 overlap=1):
+        """
+        Watches the instances started from a live image, yielding a
+        (change, server, old_status) tuple for every change seen. Change is
+        one of 'added', 'removed' or 'changed'. The instances in known are
+        taken to be already seen; by default all current instances are
+        reported as added first.
+
+        Every interval seconds the IDs of the instances are listed, and only
+        the servers that changed since the last poll are fetched (using a
+        changes-since query). Listing the IDs still costs O(instances) per
+        poll, but fetching servers only costs O(changes). The changes-since
+        marker is taken from the newest updated timestamp the API has
+        returned, less overlap seconds, so it does not depend on the local
+        clock agreeing with the API's.
+        """
+        clones = {}
+        if known is None:
+            known = self.iter_live_image_servers(server)
+            for clone in known:
+                clones[clone.id] = clone
+                yield ('added', clone, None)
+        else:
+            for clone in known:
+                clones[clone.id] = clone
+
+        newest = None
+        for clone in clones.values():
+            newest = max(newest, _server_updated(clone))
+        if newest is None:
+            # Nothing has been returned by the API yet, so all we have to go
+            # on is our own clock.
+            newest = time.time()
+
+        while True:
+            time.sleep(interval)
+            changes_since = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                          time.gmtime(newest - overlap))
+
+            changed = {}
+            for updated in self.list(search_opts={'changes-since':
+                                                  changes_since}):
+                changed[updated.id] = updated
+                newest = max(newest, _server_updated(updated))
+            ids = set(self._live_image_server_ids(server))
+
+            for clone_id in set(clones.keys()) - ids:
+                yield ('removed', clones.pop(clone_id), None)
+            for clone_id in ids:
+                if clone_id not in clones:
+                    try:
+                        clone = changed.get(clone_id) or self.get(clone_id)
+                    except exceptions.NotFound:
+                        continue
+                    clones[clone_id] = clone
+                    newest = max(newest, _server_updated(clone))
+                    yield ('added', clone, None)
+                elif clone_id in changed:
+                    old = clones[clone_id]
+                    clones[clone_id] = changed[clone_id]
+                    if old.status != changed[clone_id].status:
+                        yield ('changed', changed[clone_id], old.status)
+
+    def _iter_pages(self, action, server, page_size):
+        """
+        Yields the servers listed by action one page at a time. If the API
+        supports pagination each page is requested with a marker and limit,
+        otherwise the full list of IDs is requested once and the servers are
+        fetched a page at a time, concurrently. Servers that are deleted
+        while being listed are skipped.
+        """
+        if page_size < 1:
+            raise ValueError("page_size must be at least 1.")
+        try:
+            paginate = self.satisfies(['list-pagination'])
+        except Exception:
+            # Listing did not use to depend on /gcinfo, so an API without
+            # it is simply taken to have no pagination (or any other
+            # capability, so that it is not asked again for every listing).
+            self.capabilities = []
+            paginate = False
+        if paginate:
+            marker = None
+            while True:
+                params = {'limit': page_size}
+                if marker is not None:
+                    params['marker'] = marker
+                header, info = self._action(action, base.getid(server), params)
+                for listed in self._hydrate([s['id'] for s in info],
+                                            page_size):
+                    yield listed
+                if len(info) < page_size:
+                    return
+                marker = info[-1]['id']
+        else:
+            header, info = self._action(action, base.getid(server))
+            for listed in self._hydrate([s['id'] for s in info], page_size):
+                yield listed
+
+    def _hydrate(self, server_ids, page_size):
+        for start in range(0, len(server_ids), page_size):
+            results = bulk.run_parallel(self.get,
+                                        server_ids[start:start + page_size])
+            for result in results:
+                if result.ok:
+                    yield result.value
+                elif not isinstance(result.error, exceptions.NotFound):
+                    raise result.error
+
+    def _live_image_server_ids(self, server):
         header, info = self._action("gc_list_launched", base.getid(server))
-        return [self.get(server['id']) for server in info]
+        return [server['id'] for server in info]
 
     def list_blessed(self, *args, **kwargs):
         """ Deprecated. Please use list_live_images(...). """
         return self.list_live_images(*args, **kwargs)
 
     def list_live_images(self, server):
-        header, info = self._action("gc_list_blessed", base.getid(server))
-        return [self.get(server['id']) for server in info]
+        return list(self.iter_live_images(server))
+
+    def iter_live_images(self, server, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Yields the live images of an instance, fetching them a page of
+        page_size at a time. See _iter_pages(...).
+        """
+        return self._iter_pages("gc_list_blessed", server, page_size)
 
     def export(self, server):
         header, info = self._action("gc_export", server.id)
         return info
 
+    def export_live_images(self, live_images, max_workers=bulk.DEFAULT_WORKERS,
+                           callback=None):
+        """
+        Exports many live images concurrently, using at most max_workers
+        threads. Returns a list of bulk.Result objects whose values are the
+        exported data. If given, callback(result) is invoked as each export
+        finishes.
+        """
+        return bulk.run_parallel(self.export, live_images,
+                                 max_workers=max_workers, callback=callback,
+                                 metrics=self.metrics, phase='export')
+
+    def wait_for_images(self, image_ids, timeout=3600, interval=5,
+                        max_interval=60, callback=None):
+        """
+        Waits for many images (e.g. the export_image_id of exports) to become
+        active. All pending images are tracked by a single poller, which
+        starts polling every interval seconds and backs off up to every
+        max_interval seconds while none of them change. Returns a list of
+        bulk.Result objects in the order of image_ids, where value is the
+        image, duration is the time it took to become active and size is its
+        size in bytes if the API reports it. If given, callback(result) is
+        invoked as each image finishes.
+        """
+        results = [bulk.Result(image_id) for image_id in image_ids]
+        pending = dict((result.item, result) for result in results)
+        metrics = self.metrics
+        start = time.time()
+        for result in results:
+            result.size = None
+            if metrics is not None:
+                metrics.set_state(result.item, 'saving')
+
+        def finish(result, image=None, error=None):
+            del pending[result.item]
+            result.value = image
+            result.error = error
+            result.duration = time.time() - start
+            if image is not None:
+                result.size = getattr(image, 'OS-EXT-IMG-SIZE:size', None)
+            if metrics is not None:
+                metrics.observe('export-wait', result.duration)
+                metrics.set_state(result.item,
+                                  result.ok and 'done' or 'failed')
+            if callback is not None:
+                callback(result)
+
+        delay = interval
+        while pending:
+            changed = False
+            for result in pending.values():
+                try:
+                    image = self.scheduler.run(
+                        lambda: self.api.images.get(result.item), retry=True)
+                except Exception, e:
+                    finish(result, error=e)
+                    changed = True
+                    continue
+                status = image.status
+                progress = getattr(image, 'progress', None)
+                if (status, progress) != getattr(result, 'seen', None):
+                    result.seen = (status, progress)
+                    changed = True
+                if status == 'ACTIVE':
+                    finish(result, image)
+                elif status in ['ERROR', 'DELETED', 'KILLED']:
+                    finish(result, image,
+                           Exception("Image went into %s state." % status))
+                elif time.time() - start > timeout:
+                    finish(result, image,
+                           Exception('Timeout: waited %ss for image.' %
+                                     timeout))
+            if not pending:
+                break
+            if changed:
+                delay = interval
+            else:
+                delay = min(max_interval, delay * 2)
+            time.sleep(delay)
+        return results
+
     def import_instance(self, data):
         url = "/gc-import-server"
         body = {'data': data}
@@ -638,13 +1765,16 @@ class CoServerManager(servers.ServerManager):
             "wait": wait,
         }
 
-        return self.api.client.post(url, body=body)
+        return self.scheduler.run(lambda: self._client().post(url, body=body),
+                                  retry=True)
 
     def get_policy(self, server):
         header, info = self._action("co_get_policy", base.getid(server))
         return info
 
     def install_agent(self, server, user, key_path, location=None,
-                        version=None, ip=None):
+                        version=None, ip=None, output=None, lineage=None,
+                        distro_cache=None):
         agent.install(server, user, key_path, location=location,
-                        version=version, ip=ip)
+                        version=version, ip=ip, output=output,
+                        lineage=lineage, distro_cache=distro_cache)
@@ -13,29 +13,38 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 import sys
+import json
 import time
+import select
 import subprocess
 import threading
+import collections
 
 from subprocess import PIPE
 
+from . import bulk
+
 DEFAULT_LOCATION = "http://downloads.gridcentriclabs.com/packages/agent/linux"
 
 TEST_SCRIPT = """
 exit 0
 """
 
-# NOTE: The below script requires a single string substition,
-# as the bottom. This is the base location of the package repos,
-# and will default to the DEFAULT_LOCATION as provided above.
-INSTALL_SCRIPT = """
+# Lines of output starting with this are recorded by OutputCapture rather
+# than printed, and are used by the install scripts to report what they found.
+MARKER = "@@cobalt "
+
+SCRIPT_HEADER = """
 PS1=
 set -x
 set -e
 # Ensure a sensible path for all covered distributions.
 export PATH=/usr/local/bin:/usr/bin:/bin:/usr/local/sbin:/usr/sbin:/sbin
+"""
 
+DETECT_SCRIPT = """
 # Automatically determine the repo if it wasn't specified.
 if grep -i "DISTRIB_ID=Ubuntu" /etc/lsb-release > /dev/null 2>&1; then
     REPO="ubuntu"
@@ -75,6 +84,32 @@ case $ARCH in
         exit 1
 esac
 
+# Report what we found, so that it can be reused for clones of this guest.
+set +x
+echo "%(marker)srepo=$REPO"
+echo "%(marker)sarch=$ARCH"
+set -x
+"""
+
+# NOTE: This replaces DETECT_SCRIPT for guests whose distribution is already
+# known. It also allows the repository setup to be skipped where the guest
+# already has it (as clones of a live image with the agent installed do).
+KNOWN_SCRIPT = """
+REPO="%(repo)s"
+ARCH="%(arch)s"
+if [ "$REPO" = "cirros" ]; then
+    REPO_DIR="tgz"
+else
+    REPO_DIR=$REPO
+fi
+SKIP_REPO=1
+"""
+
+# NOTE: The below script requires a string substition for the base location
+# of the package repos (which will default to the DEFAULT_LOCATION as provided
+# above) and the version.
+INSTALL_BODY = """
+
 # Check if we need sudo.
 if [ $(whoami) != "root" ]; then
     if [ -x /usr/bin/sudo ]; then
@@ -110,7 +145,16 @@ install_deb_packages() {
     # Update the metadata.
     # NOTE: We may limit it to the new sources, however below we do include
     # the linux-headers (as they may be required to build the kernel module).
-    $SUDO apt-get update
+    # Where the repository was already set up (e.g. on a clone), the other
+    # lists are as recent as the guest's kernel, so only ours is refreshed.
+    if [ "$HAVE_REPO" != "1" ]; then
+        $SUDO apt-get update
+    else
+        $SUDO apt-get update \\
+            -o Dir::Etc::sourcelist=sources.list.d/gridcentric.list \\
+            -o Dir::Etc::sourceparts=- \\
+            -o APT::Get::List-Cleanup=0
+    fi
 
     # Figure out if we need a version string.
     if [ "%(version)s" != "latest" ]; then
@@ -184,10 +228,16 @@ install_cirros_packages() {
 URL="%(location)s/$REPO_DIR"
 
 if [ "$REPO" = "ubuntu" -o "$REPO" = "deb" ]; then
-    install_deb_repo $URL
+    if [ "$SKIP_REPO" = "1" -a -e /etc/apt/sources.list.d/gridcentric.list ]; then
+        HAVE_REPO=1
+    else
+        install_deb_repo $URL
+    fi
     install_deb_packages
 elif [ "$REPO" = "centos" -o "$REPO" = "rpm" ]; then
-    install_rpm_repo $URL
+    if [ "$SKIP_REPO" != "1" -o ! -e /etc/yum.repos.d/gridcentric.repo ]; then
+        install_rpm_repo $URL
+    fi
     install_rpm_packages
 elif [ "$REPO" = "cirros" ]; then
     install_cirros_packages $URL
@@ -196,6 +246,48 @@ fi
 exit 0
 """
 
+INSTALL_SCRIPT = SCRIPT_HEADER + DETECT_SCRIPT + INSTALL_BODY
+
+DEFAULT_DISTRO_CACHE = os.path.expanduser('~/.cobalt_agent_distros')
+
+class DistroCache(object):
+    """
+    Remembers the distribution and architecture detected on the guests of
+    each live image, so that they need not be detected again on its clones.
+    If a path is given, the cache is loaded from and saved to that file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                # A corrupt cache is simply rebuilt.
+                self.entries = {}
+
+    def get(self, lineage):
+        self.lock.acquire()
+        try:
+            return self.entries.get(lineage)
+        finally:
+            self.lock.release()
+
+    def put(self, lineage, distro):
+        self.lock.acquire()
+        try:
+            self.entries[lineage] = distro
+            if self.path is not None:
+                tmp = '%s.%d' % (self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(self.entries, f)
+                os.rename(tmp, self.path)
+        finally:
+            self.lock.release()
+
 def get_addrs(server):
     ips = []
     for network in server.networks.values():
@@ -204,6 +296,205 @@ def get_addrs(server):
         raise Exception("Server %s has no IP addresses." % str(server.id))
     return ips
 
+class OutputCapture(object):
+    """
+    Collects the output of many ssh children at once.
+
+    A single thread reads the stdout and stderr of every registered child
+    as it becomes available, so that no child ever blocks on a full pipe.
+    Each line is prefixed with the host it came from and written to stream
+    (if given), appended to <log_dir>/<host>.log (if log_dir is given), and
+    kept in a per-host ring buffer of the given number of lines. Memory use
+    is therefore bounded no matter how much the children write. A host's
+    log file is only open while one of its children is running. Call
+    close() once done to stop the reading thread.
+    """
+
+    # Lines longer than this are split, to bound memory use.
+    MAX_LINE = 4096
+
+    def __init__(self, lines=100, log_dir=None, stream=sys.stdout):
+        self.lines = lines
+        self.log_dir = log_dir
+        self.stream = stream
+        self.buffers = {}
+        self.found = {}
+        self.logs = {}
+        self.readers = {}
+        self.error = None
+        self.closed = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = None
+
+    def register(self, host, proc):
+        """ Starts capturing the stdout and stderr of proc for host. """
+        self.lock.acquire()
+        try:
+            self._check()
+            if host not in self.buffers:
+                self.buffers[host] = collections.deque(maxlen=self.lines)
+            if self.log_dir is not None and host not in self.logs:
+                self.logs[host] = open(os.path.join(self.log_dir,
+                                                    '%s.log' % host), 'a')
+            self.found[host] = {}
+            for f in [proc.stdout, proc.stderr]:
+                self.readers[f.fileno()] = [host, f, '']
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+        os.write(self.wake_w, 'x')
+
+    def wait(self, proc):
+        """
+        Waits for proc to exit and its output to be consumed. Raises an
+        exception if capturing the output failed.
+        """
+        self.cond.acquire()
+        try:
+            while not (proc.stdout.closed and proc.stderr.closed):
+                self._check()
+                self.cond.wait(1)
+        finally:
+            self.cond.release()
+        return proc.wait()
+
+    def close(self):
+        """ Stops the reading thread and closes all files. """
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+        finally:
+            self.lock.release()
+        os.write(self.wake_w, 'x')
+        if self.thread is not None:
+            self.thread.join()
+        for reader in self.readers.values():
+            reader[1].close()
+        self.readers.clear()
+        for log in self.logs.values():
+            log.close()
+        self.logs.clear()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def tail(self, host, n=None):
+        """ Returns the last n lines (default all kept) output by host. """
+        self.lock.acquire()
+        try:
+            lines = list(self.buffers.get(host, []))
+        finally:
+            self.lock.release()
+        if n is not None:
+            lines = lines[-n:]
+        return lines
+
+    def reported(self, host):
+        """
+        Returns a dict of the key=value pairs reported by the last child run
+        for host on lines starting with MARKER.
+        """
+        self.lock.acquire()
+        try:
+            return dict(self.found.get(host, {}))
+        finally:
+            self.lock.release()
+
+    def _check(self):
+        # Called with the lock held.
+        if self.error is not None:
+            raise Exception("Capturing ssh output failed: %s" % self.error)
+        if self.closed:
+            raise Exception("Output capture has been closed.")
+
+    def _emit(self, host, line):
+        # Called with the lock held.
+        if line.startswith(MARKER):
+            key, _, value = line[len(MARKER):].partition('=')
+            self.found[host][key] = value
+            return
+        self.buffers[host].append(line)
+        if self.stream is not None:
+            self.stream.write('[%s] %s\n' % (host, line))
+            self.stream.flush()
+        if host in self.logs:
+            self.logs[host].write(line + '\n')
+            self.logs[host].flush()
+
+    def _finish(self, fd):
+        # Called with the lock held, once fd has reached EOF.
+        host, f, pending = self.readers.pop(fd)
+        if pending:
+            self._emit(host, pending)
+        f.close()
+        if host in self.logs and \
+           host not in [reader[0] for reader in self.readers.values()]:
+            self.logs.pop(host).close()
+
+    def _run(self):
+        try:
+            self._read()
+        except Exception, e:
+            self.cond.acquire()
+            try:
+                self.error = e
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+    def _read(self):
+        # NOTE: poll() is used rather than select(), as select() cannot
+        # handle file descriptors numbered above FD_SETSIZE (1024), which a
+        # large rollout easily reaches.
+        registered = set()
+        poller = select.poll()
+        poller.register(self.wake_r, select.POLLIN)
+        while True:
+            self.lock.acquire()
+            try:
+                if self.closed:
+                    return
+                fds = set(self.readers.keys())
+            finally:
+                self.lock.release()
+            for fd in registered - fds:
+                poller.unregister(fd)
+            for fd in fds - registered:
+                poller.register(fd, select.POLLIN)
+            registered = fds
+
+            ready = [fd for fd, event in poller.poll()]
+            if self.wake_r in ready:
+                os.read(self.wake_r, 4096)
+                ready.remove(self.wake_r)
+            for fd in ready:
+                data = os.read(fd, 4096)
+                self.cond.acquire()
+                try:
+                    if not data:
+                        self._finish(fd)
+                        self.cond.notifyAll()
+                        continue
+                    reader = self.readers[fd]
+                    host = reader[0]
+                    pending = reader[2] + data
+                    lines = pending.split('\n')
+                    pending = lines.pop()
+                    while len(pending) > self.MAX_LINE:
+                        lines.append(pending[:self.MAX_LINE])
+                        pending = pending[self.MAX_LINE:]
+                    reader[2] = pending
+                    for line in lines:
+                        self._emit(host, line.rstrip('\r'))
+                finally:
+                    self.cond.release()
+
 class SecureShell(object):
 
     def __init__(self, server, user, key_path, preferred_ip=None):
@@ -231,10 +522,27 @@ class SecureShell(object):
         cmd += ["%s@%s" % (self.user, self.host)]
         return cmd
 
-    def call(self, script):
+    def call(self, script, output=None):
         # Our command is always a remote shell for execution.
         command = self.ssh_args() + ['sh', '-']
 
+        if output is not None:
+            # Capture the output through the given OutputCapture, so that
+            # many calls may run side by side.
+            p = subprocess.Popen(command,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 close_fds=True)
+            output.register(self.host, p)
+            try:
+                p.stdin.write("stty -echo 2>/dev/null || true;\n" + script)
+                p.stdin.close()
+            except IOError:
+                # The child has gone away; its exit code tells us why.
+                pass
+            return output.wait(p)
+
         # Open an ssh instance.
         # NOTE: We used to pull fancy tricks with stdout, stderr
         # but instead we just allow them to come through as they
@@ -249,28 +557,31 @@ class SecureShell(object):
         p.communicate("stty -echo 2>/dev/null || true;\n" + script)
         return p.returncode
 
-def wait_for(message, condition, duration=600, interval=1):
-    sys.stderr.write("Waiting %ss for %s..." % (duration, message))
-    sys.stderr.flush()
+def wait_for(message, condition, duration=600, interval=1, quiet=False):
+    if not quiet:
+        sys.stderr.write("Waiting %ss for %s..." % (duration, message))
+        sys.stderr.flush()
     start = time.time()
     while True:
         if condition():
-            sys.stderr.write("done\n")
+            if not quiet:
+                sys.stderr.write("done\n")
             return
         remaining = start + duration - time.time()
         if remaining <= 0:
             raise Exception('Timeout: waited %ss for %s' % (duration, message))
         time.sleep(min(interval, remaining))
 
-def wait_while_status(server, status):
+def wait_while_status(server, status, quiet=False):
     def condition():
         if server.status != status:
             return True
         server.get()
         return False
-    wait_for('%s on ID %s to finish' % (status, str(server.id)), condition)
+    wait_for('%s on ID %s to finish' % (status, str(server.id)), condition,
+             quiet=quiet)
 
-def wait_for_ssh(server, user, key_path, ip=None):
+def wait_for_ssh(server, user, key_path, ip=None, output=None, quiet=False):
     if ip is not None:
         ips = [ip]
     else:
@@ -283,21 +594,55 @@ def wait_for_ssh(server, user, key_path, ip=None):
             ssh = SecureShell(server, user, key_path, ip)
             try:
                 wait_for('ssh ID %s:%s to respond' % (str(server.id), ip),
-                         lambda: ssh.call(TEST_SCRIPT) == 0,
-                         duration=duration)
+                         lambda: ssh.call(TEST_SCRIPT, output) == 0,
+                         duration=duration, quiet=quiet)
                 return ip
             except Exception:
                 continue
     raise Exception("Server %s had no IP address respond to ssh (%s)." %\
                     (str(server.id), str(ips)))
 
-def do_install(server, ip, user, key_path, location, version):
+def do_install(server, ip, user, key_path, location, version, output=None,
+               tail=20, lineage=None, distro_cache=None):
     ssh = SecureShell(server, user, key_path, ip)
-    args = { "location" : location, "version" : version }
-    if ssh.call(INSTALL_SCRIPT % args) != 0:
-        raise Exception("Error during installation.")
-
-def install(server, user, key_path, location=None, version=None, ip=None):
+    args = { "location" : location, "version" : version, "marker" : MARKER }
+
+    # If we have seen this server's live image before, we already know its
+    # distribution and can skip detection and repository setup.
+    known = None
+    owned = None
+    if lineage is not None and distro_cache is not None:
+        known = distro_cache.get(lineage)
+        if known is None and output is None:
+            # We need to read what the script detects.
+            output = owned = OutputCapture()
+    try:
+        _do_install(ssh, args, output, tail, lineage, distro_cache, known)
+    finally:
+        if owned is not None:
+            owned.close()
+
+def _do_install(ssh, args, output, tail, lineage, distro_cache, known):
+    if known is not None:
+        args.update([(key, str(value)) for key, value in known.items()])
+        script = SCRIPT_HEADER + KNOWN_SCRIPT + INSTALL_BODY
+    else:
+        script = INSTALL_SCRIPT
+
+    if ssh.call(script % args, output) != 0:
+        if output is None:
+            raise Exception("Error during installation.")
+        raise Exception("Error during installation on %s. Last output:\n%s" %
+                        (ssh.host, '\n'.join(output.tail(ssh.host, tail))))
+
+    if known is None and distro_cache is not None and lineage is not None:
+        found = output.reported(ssh.host)
+        if 'repo' in found and 'arch' in found:
+            distro_cache.put(lineage, {'repo': found['repo'],
+                                       'arch': found['arch']})
+
+def install(server, user, key_path, location=None, version=None, ip=None,
+            output=None, lineage=None, distro_cache=None):
     if location == None:
         location = DEFAULT_LOCATION
     if version == None:
@@ -305,5 +650,43 @@ def install(server, user, key_path, location=None, version=None, ip=None):
     wait_while_status(server, 'BUILD')
     if server.status != 'ACTIVE':
         raise Exception("Server is not active.")
-    ip = wait_for_ssh(server, user, key_path, ip=ip)
-    do_install(server, ip, user, key_path, location, version)
+    ip = wait_for_ssh(server, user, key_path, ip=ip, output=output)
+    do_install(server, ip, user, key_path, location, version, output=output,
+               lineage=lineage, distro_cache=distro_cache)
+
+def install_pipeline(user, key_path, location=None, version=None, output=None,
+                     active_workers=8, ssh_workers=8, install_workers=4,
+                     callback=None, lineage=None, distro_cache=None,
+                     metrics=None):
+    """
+    Returns a started bulk.Pipeline which installs the agent on every server
+    put into it. Each server waits to become ACTIVE, then for ssh, then has
+    the agent installed, with each of these stages served by its own pool of
+    workers so that no server waits on another. The servers are taken to be
+    clones of the live image lineage when using distro_cache.
+    """
+    if location == None:
+        location = DEFAULT_LOCATION
+    if version == None:
+        version = 'latest'
+
+    def active(server):
+        wait_while_status(server, 'BUILD', quiet=True)
+        if server.status != 'ACTIVE':
+            raise Exception("Server is not active.")
+        return server
+
+    def ssh(server):
+        return server, wait_for_ssh(server, user, key_path, output=output,
+                                    quiet=True)
+
+    def install_on(args):
+        server, ip = args
+        do_install(server, ip, user, key_path, location, version,
+                   output=output, lineage=lineage, distro_cache=distro_cache)
+        return server
+
+    return bulk.Pipeline([('active', active, active_workers),
+                          ('ssh', ssh, ssh_workers),
+                          ('install', install_on, install_workers)],
+                         callback=callback, metrics=metrics).start()
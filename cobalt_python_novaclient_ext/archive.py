@@ -0,0 +1,117 @@
+# Copyright 2011 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Archives holding the exported data of many live images.
+
+An archive is a zip file with one compressed entry per live image, named
+<live image id>.json and holding exactly what live-image-export writes for
+it, plus a manifest.json index. Each entry can therefore be extracted on
+its own (e.g. with unzip) and passed to live-image-import.
+"""
+
+import json
+import time
+import hashlib
+import zipfile
+import threading
+
+MANIFEST = 'manifest.json'
+
+def format_export(data):
+    """ Formats exported live image data as written by live-image-export. """
+    return json.dumps(data, sort_keys=True, indent=4,
+                      separators=(',', ': ')) + '\n'
+
+class ExportArchive(object):
+    """ Writes exported live images into an archive as they arrive. """
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self.manifest = []
+        self.lock = threading.Lock()
+
+    def add(self, live_image, data):
+        contents = format_export(data)
+        entry = {'file': '%s.json' % live_image.id,
+                 'live_image_id': live_image.id,
+                 'name': live_image.name,
+                 'export_image_id': data.get('export_image_id'),
+                 'size': len(contents),
+                 'sha256': hashlib.sha256(contents).hexdigest(),
+                 'exported_at': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                              time.gmtime())}
+        self.lock.acquire()
+        try:
+            self.zip.writestr(entry['file'], contents)
+            self.manifest.append(entry)
+        finally:
+            self.lock.release()
+        return entry
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.zip.writestr(MANIFEST, format_export({'entries':
+                                                       self.manifest}))
+            self.zip.close()
+        finally:
+            self.lock.release()
+
+def read_manifest(path):
+    """ Returns the list of manifest entries of an archive. """
+    z = zipfile.ZipFile(path, 'r')
+    try:
+        return json.loads(z.read(MANIFEST))['entries']
+    finally:
+        z.close()
+
+def _read_checked(z, path, entry):
+    contents = z.read(entry['file'])
+    if hashlib.sha256(contents).hexdigest() != entry['sha256']:
+        raise Exception("Checksum mismatch for %s in %s." %
+                        (entry['file'], path))
+    return json.loads(contents)
+
+def read_entry(path, live_image_id):
+    """
+    Returns the exported data of one live image from an archive, after
+    checking it against the manifest.
+    """
+    z = zipfile.ZipFile(path, 'r')
+    try:
+        entries = json.loads(z.read(MANIFEST))['entries']
+        for entry in entries:
+            if live_image_id in [entry['live_image_id'], entry['name']]:
+                return _read_checked(z, path, entry)
+        raise Exception("No live-image %s in %s." % (live_image_id, path))
+    finally:
+        z.close()
+
+def iter_entries(path):
+    """
+    Yields the (manifest entry, exported data) of every live image in an
+    archive, checking each against the manifest.
+    """
+    z = zipfile.ZipFile(path, 'r')
+    try:
+        for entry in json.loads(z.read(MANIFEST))['entries']:
+            yield entry, _read_checked(z, path, entry)
+    finally:
+        z.close()
+
+def is_archive(path):
+    return zipfile.is_zipfile(path)
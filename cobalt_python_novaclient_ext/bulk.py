@@ -0,0 +1,226 @@
+# Copyright 2011 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Helpers for running cobalt operations over many servers at once.
+"""
+
+import time
+import threading
+import Queue
+
+DEFAULT_WORKERS = 4
+
+class Result(object):
+    """ The outcome of running an operation against a single item. """
+
+    def __init__(self, item):
+        self.item = item
+        self.value = None
+        self.error = None
+        self.duration = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def _key(item, index):
+    # Items are tracked in metrics by their ID where they have one.
+    return getattr(item, 'id', index)
+
+def _callback(callback, result):
+    """
+    Invokes callback(result), recording any error it raises on the result
+    so that a failing callback neither kills its worker thread nor lets the
+    item be reported as done.
+    """
+    if callback is None:
+        return
+    try:
+        callback(result)
+    except Exception, e:
+        if result.ok:
+            result.error = e
+
+def run_parallel(fn, items, max_workers=DEFAULT_WORKERS, callback=None,
+                 metrics=None, phase='run'):
+    """
+    Call fn(item) for every item using at most max_workers threads. Errors
+    are captured rather than raised. Returns a list of Result objects in the
+    same order as items. If given, callback(result) is invoked as each item
+    finishes (from the worker thread); an error raised by the callback is
+    recorded as the error of that item. If metrics is given, the state of
+    each item and the latency of phase are recorded in it.
+    """
+    items = list(items)
+    results = [Result(item) for item in items]
+    if len(items) == 0:
+        return results
+
+    work = Queue.Queue()
+    for index, result in enumerate(results):
+        result.key = _key(result.item, index)
+        if metrics is not None:
+            metrics.set_state(result.key, 'pending')
+        work.put(result)
+
+    def worker():
+        while True:
+            try:
+                result = work.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            if metrics is not None:
+                metrics.set_state(result.key, phase)
+                metrics.begin()
+            try:
+                result.value = fn(result.item)
+            except Exception, e:
+                result.error = e
+            result.duration = time.time() - start
+            _callback(callback, result)
+            if metrics is not None:
+                metrics.end()
+                metrics.observe(phase, result.duration)
+                metrics.set_state(result.key,
+                                  result.ok and 'done' or 'failed')
+
+    threads = []
+    for i in range(max(1, min(max_workers, len(items)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        # NOTE: Joining with a timeout keeps the main thread responsive to
+        # KeyboardInterrupt in python 2.
+        while t.is_alive():
+            t.join(1)
+    return results
+
+class Pipeline(object):
+    """
+    Moves items through a series of stages, each with its own pool of
+    worker threads, so that an item enters the next stage as soon as it is
+    done with the previous one. Stages are given as a list of
+    (name, fn, workers) where fn takes the value produced by the previous
+    stage (the item itself for the first stage) and returns the value for
+    the next. An item that fails a stage leaves the pipeline.
+
+    Items may be put in at any time after start(). join() waits for all
+    items to leave the pipeline and returns their Result objects, where
+    value is the output of the last stage. Each result also records the
+    stage it failed in (if any) and a timings dict of seconds per stage.
+    If metrics is given, the stage each item is in and the latency of each
+    stage are recorded in it.
+    """
+
+    def __init__(self, stages, callback=None, metrics=None):
+        for name, fn, workers in stages:
+            if workers < 1:
+                raise ValueError("Stage %s needs at least one worker." % name)
+        self.stages = stages
+        self.callback = callback
+        self.metrics = metrics
+        self.queues = [Queue.Queue() for stage in stages]
+        self.results = []
+        self.outstanding = 0
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        for index, (name, fn, workers) in enumerate(self.stages):
+            for i in range(workers):
+                t = threading.Thread(target=self._worker, args=(index,))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+        return self
+
+    def put(self, item):
+        result = Result(item)
+        result.stage = None
+        result.timings = {}
+        self.cond.acquire()
+        try:
+            result.key = _key(item, len(self.results))
+            self.results.append(result)
+            self.outstanding += 1
+        finally:
+            self.cond.release()
+        if self.metrics is not None:
+            self.metrics.set_state(result.key, 'pending')
+        self.queues[0].put((result, item))
+
+    def latencies(self):
+        """ Returns a dict of the list of seconds taken per stage. """
+        latencies = {}
+        for name, fn, workers in self.stages:
+            latencies[name] = [r.timings[name] for r in self.results
+                               if name in r.timings]
+        return latencies
+
+    def join(self):
+        self.cond.acquire()
+        try:
+            while self.outstanding > 0:
+                self.cond.wait(1)
+        finally:
+            self.cond.release()
+        for queue, (name, fn, workers) in zip(self.queues, self.stages):
+            for i in range(workers):
+                queue.put(None)
+        return list(self.results)
+
+    def _finish(self, result):
+        _callback(self.callback, result)
+        if self.metrics is not None:
+            self.metrics.set_state(result.key,
+                                   result.ok and 'done' or 'failed')
+        self.cond.acquire()
+        try:
+            self.outstanding -= 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _worker(self, index):
+        name, fn, workers = self.stages[index]
+        while True:
+            work = self.queues[index].get()
+            if work is None:
+                return
+            result, value = work
+            start = time.time()
+            if self.metrics is not None:
+                self.metrics.set_state(result.key, name)
+                self.metrics.begin()
+            try:
+                value = fn(value)
+            except Exception, e:
+                result.error = e
+                result.stage = name
+            result.timings[name] = time.time() - start
+            if self.metrics is not None:
+                self.metrics.end()
+                self.metrics.observe(name, result.timings[name])
+            result.duration += result.timings[name]
+            if result.error is None and index + 1 < len(self.stages):
+                self.queues[index + 1].put((result, value))
+            else:
+                if result.error is None:
+                    result.value = value
+                self._finish(result)
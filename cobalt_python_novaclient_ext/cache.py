@@ -0,0 +1,80 @@
+# Copyright 2011 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+An in-process cache of server details.
+"""
+
+import time
+import threading
+
+from collections import OrderedDict
+
+DEFAULT_TTL = 30
+DEFAULT_SIZE = 1000
+
+class ServerCache(object):
+    """
+    A thread-safe cache of server info dicts keyed by server ID. Entries
+    expire ttl seconds after they were stored, and the least recently used
+    entries are evicted once there are more than max_size of them.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, server_id):
+        """ Returns the cached info for server_id, or None. """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(server_id, None)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as the most recently used.
+            self.entries[server_id] = entry
+            self.hits += 1
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def put(self, info):
+        self.lock.acquire()
+        try:
+            self.entries.pop(info['id'], None)
+            self.entries[info['id']] = (time.time(), info)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, server_id):
+        self.lock.acquire()
+        try:
+            self.entries.pop(server_id, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
@@ -0,0 +1,121 @@
+# Copyright 2011 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Keep-alive connection pooling for the novaclient HTTP client.
+"""
+
+import time
+import threading
+
+try:
+    import requests
+    from requests import adapters
+except ImportError:
+    requests = None
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_PER_HOST = 10
+DEFAULT_IDLE_TIMEOUT = 60
+
+if requests is not None:
+
+    class PooledSession(requests.Session):
+        """
+        A requests session that keeps connections alive between requests.
+
+        pool_size is the number of hosts for which connections are kept,
+        pool_per_host the number of connections kept to each host. Pooled
+        connections are dropped once the session has been idle for more than
+        idle_timeout seconds, as the server has likely closed them anyway.
+        """
+
+        def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                     pool_per_host=DEFAULT_POOL_PER_HOST,
+                     idle_timeout=DEFAULT_IDLE_TIMEOUT):
+            requests.Session.__init__(self)
+            self.idle_timeout = idle_timeout
+            self.idle_resets = 0
+            self.retired_requests = 0
+            self.retired_connections = 0
+            self.last_used = None
+            self.lock = threading.Lock()
+            for prefix in ['http://', 'https://']:
+                self.mount(prefix,
+                           adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_per_host))
+
+        def request(self, *args, **kwargs):
+            now = time.time()
+            self.lock.acquire()
+            try:
+                if self.idle_timeout is not None and \
+                   self.last_used is not None and \
+                   now - self.last_used > self.idle_timeout:
+                    self.clear()
+                    self.idle_resets += 1
+                self.last_used = now
+            finally:
+                self.lock.release()
+            return requests.Session.request(self, *args, **kwargs)
+
+        def clear(self):
+            """ Closes all pooled connections. """
+            requests_made, connections = self._pool_counts()
+            self.retired_requests += requests_made
+            self.retired_connections += connections
+            for adapter in self.adapters.values():
+                adapter.poolmanager.clear()
+
+        def _pool_counts(self):
+            requests_made = 0
+            connections = 0
+            for adapter in self.adapters.values():
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    requests_made += pool.num_requests
+                    connections += pool.num_connections
+            return requests_made, connections
+
+        def stats(self):
+            """
+            Returns counts of the requests made and connections opened through
+            this session. Every request beyond the first on a connection
+            reused that connection.
+            """
+            requests_made, connections = self._pool_counts()
+            requests_made += self.retired_requests
+            connections += self.retired_connections
+            return {'requests': requests_made,
+                    'connections': connections,
+                    'reused': max(0, requests_made - connections),
+                    'idle_resets': self.idle_resets}
+
+def attach(client, session):
+    """
+    Routes the requests of a novaclient HTTP client through session. Returns
+    False if this version of novaclient does not allow it.
+    """
+    if hasattr(client, '_get_session'):
+        # Newer clients look up a session per endpoint.
+        client._get_session = lambda url: session
+        return True
+    if hasattr(client, 'http') and hasattr(client.http, 'request'):
+        client.http = session
+        return True
+    return False
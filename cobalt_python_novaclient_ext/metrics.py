@@ -0,0 +1,205 @@
+# Copyright 2011 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Progress metrics for long running bulk cobalt operations.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import collections
+
+# The number of latency samples kept per phase.
+MAX_SAMPLES = 10000
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+class Metrics(object):
+    """
+    Thread-safe counters for a bulk operation: the number of items in each
+    state, the number of operations in flight, the latency of each phase and
+    the number of API calls and errors.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.start = time.time()
+        self.states = {}
+        self.in_flight = 0
+        self.latencies = {}
+        self.api_calls = 0
+        self.api_errors = {}
+        self.lock = threading.Lock()
+
+    def set_state(self, item, state):
+        """ Records that item (e.g. a server ID) is now in state. """
+        self.lock.acquire()
+        try:
+            self.states[item] = state
+        finally:
+            self.lock.release()
+
+    def begin(self):
+        self.lock.acquire()
+        try:
+            self.in_flight += 1
+        finally:
+            self.lock.release()
+
+    def end(self):
+        self.lock.acquire()
+        try:
+            self.in_flight -= 1
+        finally:
+            self.lock.release()
+
+    def observe(self, phase, seconds):
+        """ Records that one item took seconds to get through phase. """
+        self.lock.acquire()
+        try:
+            if phase not in self.latencies:
+                self.latencies[phase] = collections.deque(maxlen=MAX_SAMPLES)
+            self.latencies[phase].append(seconds)
+        finally:
+            self.lock.release()
+
+    def api_call(self, error=None):
+        """ Records an API call, and the error it failed with if any. """
+        self.lock.acquire()
+        try:
+            self.api_calls += 1
+            if error is not None:
+                code = str(getattr(error, 'code', 'other'))
+                self.api_errors[code] = self.api_errors.get(code, 0) + 1
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """ Returns the current value of all metrics as a dict. """
+        self.lock.acquire()
+        try:
+            counts = {}
+            for state in self.states.values():
+                counts[state] = counts.get(state, 0) + 1
+            latency = {}
+            for phase, samples in self.latencies.items():
+                samples = sorted(samples)
+                latency[phase] = {'count': len(samples),
+                                  'max': samples and samples[-1] or 0}
+                for q in QUANTILES:
+                    latency[phase]['p%d' % int(q * 100)] = \
+                        _quantile(samples, q)
+            errors = sum(self.api_errors.values())
+            return {'time': time.time(),
+                    'operation': self.operation,
+                    'elapsed': time.time() - self.start,
+                    'states': counts,
+                    'in_flight': self.in_flight,
+                    'latency': latency,
+                    'api': {'calls': self.api_calls,
+                            'errors': errors,
+                            'error_rate': float(errors) / max(1, self.api_calls),
+                            'errors_by_code': dict(self.api_errors)}}
+        finally:
+            self.lock.release()
+
+def _quantile(samples, q):
+    if len(samples) == 0:
+        return 0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def to_json(snapshot):
+    return json.dumps(snapshot, sort_keys=True)
+
+def to_prometheus(snapshot):
+    """ Formats a snapshot in the Prometheus text exposition format. """
+    op = 'operation="%s"' % snapshot['operation']
+    lines = ['# TYPE cobalt_items gauge']
+    for state, count in sorted(snapshot['states'].items()):
+        lines.append('cobalt_items{%s,state="%s"} %d' % (op, state, count))
+    lines.append('# TYPE cobalt_in_flight gauge')
+    lines.append('cobalt_in_flight{%s} %d' % (op, snapshot['in_flight']))
+    lines.append('# TYPE cobalt_phase_latency_seconds summary')
+    for phase, latency in sorted(snapshot['latency'].items()):
+        labels = '%s,phase="%s"' % (op, phase)
+        for q in QUANTILES:
+            lines.append('cobalt_phase_latency_seconds{%s,quantile="%s"} %f' %
+                         (labels, q, latency['p%d' % int(q * 100)]))
+        lines.append('cobalt_phase_latency_seconds_count{%s} %d' %
+                     (labels, latency['count']))
+    lines.append('# TYPE cobalt_api_calls_total counter')
+    lines.append('cobalt_api_calls_total{%s} %d' %
+                 (op, snapshot['api']['calls']))
+    lines.append('# TYPE cobalt_api_errors_total counter')
+    for code, count in sorted(snapshot['api']['errors_by_code'].items()):
+        lines.append('cobalt_api_errors_total{%s,code="%s"} %d' %
+                     (op, code, count))
+    return '\n'.join(lines) + '\n'
+
+class Reporter(object):
+    """
+    Periodically writes the metrics of an operation every interval seconds.
+    With the 'json' format a JSON line is appended to path (or written to
+    stream if there is no path). With the 'prometheus' format path is
+    atomically replaced with a textfile suitable for the node exporter.
+    """
+
+    def __init__(self, metrics, path=None, format='json', interval=10,
+                 stream=sys.stderr):
+        if format not in ['json', 'prometheus']:
+            raise Exception("Unknown metrics format %s." % format)
+        if format == 'prometheus' and path is None:
+            raise Exception("The prometheus format requires a file.")
+        self.metrics = metrics
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.stream = stream
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stops reporting, writing out the final metrics. """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.emit()
+
+    def emit(self):
+        snapshot = self.metrics.snapshot()
+        if self.format == 'prometheus':
+            tmp = '%s.%d' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(to_prometheus(snapshot))
+            os.rename(tmp, self.path)
+        elif self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(to_json(snapshot) + '\n')
+        else:
+            self.stream.write(to_json(snapshot) + '\n')
+            self.stream.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.emit()
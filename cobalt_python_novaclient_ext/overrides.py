@@ -0,0 +1,130 @@
+# Copyright 2011 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Overrides of exported live image data, as given to live-image-import.
+
+An override string is a semicolon-separated list of path=value pairs, e.g.
+
+    export_image_id=THE-ID;security_groups=sg1,sg2;fields.display_name=foo
+
+Each path is a dot-separated list of keys. A key may also be the index of a
+list element, or * to apply to every element of a list (or every value of a
+dict), e.g. networks.*.net_id=NET-ID or security_groups.0=default. When the
+value being replaced is a list, the new value is split on commas.
+
+The string is compiled once into an OverridePlan, which can then be applied
+to any number of documents.
+"""
+
+WILDCARD = '*'
+
+class OverrideError(Exception):
+    pass
+
+def _describe(path):
+    return '.'.join([str(key) for key in path]) or '<document>'
+
+class Override(object):
+    """ A single compiled path=value override. """
+
+    def __init__(self, path, value):
+        self.path = path
+        self.value = value
+        self.text = '%s=%s' % (_describe(path), value)
+
+    def apply(self, data):
+        """ Applies the override to data, returning the number of values set. """
+        targets = [(data, ())]
+        for key in self.path[:-1]:
+            targets = [(child, seen + (k,))
+                       for parent, seen in targets
+                       for k, child in self._children(parent, key, seen)]
+        count = 0
+        for parent, seen in targets:
+            for k, child in self._children(parent, self.path[-1], seen):
+                if isinstance(child, list):
+                    parent[k] = self.value.split(',')
+                else:
+                    parent[k] = self.value
+                count += 1
+        return count
+
+    def _children(self, parent, key, seen):
+        """ Returns the (key, value) pairs of parent that key refers to. """
+        if key == WILDCARD:
+            if isinstance(parent, list):
+                return list(enumerate(parent))
+            elif isinstance(parent, dict):
+                return parent.items()
+        elif isinstance(parent, list):
+            try:
+                index = int(key)
+                return [(index, parent[index])]
+            except ValueError:
+                raise OverrideError("Override %s: %s is a list, expected an "
+                                    "index or %s in place of '%s'." %
+                                    (self.text, _describe(seen), WILDCARD,
+                                     key))
+            except IndexError:
+                raise OverrideError("Override %s: %s has no element %s." %
+                                    (self.text, _describe(seen), key))
+        elif isinstance(parent, dict):
+            if key not in parent:
+                raise OverrideError("Override %s: %s has no key '%s'." %
+                                    (self.text, _describe(seen), key))
+            return [(key, parent[key])]
+        raise OverrideError("Override %s: %s is a value, not a list or a "
+                            "dict." % (self.text, _describe(seen)))
+
+class OverridePlan(object):
+    """ A compiled list of overrides, see compile_plan(...). """
+
+    def __init__(self, overrides):
+        self.overrides = overrides
+
+    def apply(self, data):
+        """
+        Applies every override to data in place and returns it. Raises
+        OverrideError if a path does not exist in data, or if a wildcard
+        path matches nothing in it.
+        """
+        for override in self.overrides:
+            if override.apply(data) == 0:
+                raise OverrideError("Override %s did not match anything." %
+                                    override.text)
+        return data
+
+def compile_plan(spec):
+    """
+    Compiles an override string into an OverridePlan. Raises OverrideError
+    if the string is malformed.
+    """
+    overrides = []
+    if spec is None:
+        return OverridePlan(overrides)
+    for override_arg in spec.split(';'):
+        if override_arg.strip() == '':
+            continue
+        if '=' not in override_arg:
+            raise OverrideError("Override '%s' is not of the form "
+                                "path=value." % override_arg)
+        path, value = override_arg.split('=', 1)
+        path = tuple(path.strip().split('.'))
+        if '' in path:
+            raise OverrideError("Override '%s' has an empty key in its "
+                                "path." % override_arg)
+        overrides.append(Override(path, value))
+    return OverridePlan(overrides)
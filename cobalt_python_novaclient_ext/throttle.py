@@ -0,0 +1,148 @@
+# Copyright 2011 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Client side rate limiting and retries for the cobalt API.
+"""
+
+import time
+import random
+import threading
+
+from novaclient import exceptions
+
+# Response codes that mean the API is too busy to handle the request right
+# now, and that the same request may succeed later.
+RETRY_CODES = (409, 413, 429, 503)
+
+# Actions that do not modify anything, and so may always be retried.
+SAFE_ACTIONS = set(['gc_list_launched', 'gc_list_blessed', 'co_get_policy'])
+
+def is_retryable(e):
+    return isinstance(e, exceptions.OverLimit) or \
+           getattr(e, 'code', None) in RETRY_CODES
+
+def retry_after(e):
+    """ Returns the Retry-After hint of error e in seconds, or None. """
+    hint = getattr(e, 'retry_after', None)
+    try:
+        hint = float(hint)
+    except (TypeError, ValueError):
+        return None
+    if hint <= 0:
+        return None
+    return hint
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket. Callers take a token before each request, so
+    no more than rate requests per second are sent on average, with bursts of
+    up to burst requests. A rate of None disables the limit, although pause()
+    is still honoured.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """ Hold back all callers for the given number of seconds. """
+        self.lock.acquire()
+        try:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+        finally:
+            self.lock.release()
+
+    def acquire(self):
+        """ Blocks until a token is available and takes it. """
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self.tokens = min(self.burst, self.tokens +
+                                      (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            time.sleep(delay)
+
+class ActionScheduler(object):
+    """
+    Runs API calls through a shared token bucket. Calls that are marked as
+    retryable and fail because the API is busy are retried up to retries
+    times, waiting for the Retry-After hint of the response or else for an
+    exponential backoff with jitter. A Retry-After hint holds back every
+    caller sharing this scheduler, not just the one that received it.
+
+    An attempt may have taken effect even though its response was an
+    error. If given, done_if(e) returning True for the error of a retry
+    means the call is taken to have succeeded, provided an earlier attempt
+    failed for some other reason (e.g. a migrate rejected as already under
+    way after one that failed with a 503).
+    """
+
+    def __init__(self, rate=None, burst=1, retries=5, backoff=1.0,
+                 max_backoff=60.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.metrics = None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def run(self, call, retry=False, done_if=None):
+        attempt = 0
+        maybe_done = False
+        while True:
+            self.bucket.acquire()
+            try:
+                result = call()
+                if self.metrics is not None:
+                    self.metrics.api_call()
+                return result
+            except Exception, e:
+                if self.metrics is not None:
+                    self.metrics.api_call(e)
+                if done_if is not None:
+                    if done_if(e):
+                        if maybe_done:
+                            return None
+                    else:
+                        maybe_done = True
+                if not retry or attempt >= self.retries or \
+                   not is_retryable(e):
+                    raise
+                hint = retry_after(e)
+                if hint is not None:
+                    self.bucket.pause(hint)
+                else:
+                    time.sleep(self.delay(attempt))
+                attempt += 1